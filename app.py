@@ -1,16 +1,23 @@
 from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, make_response
 import pandas as pd
+import numpy as np
 import yfinance as yf
 import os
-from datetime import datetime, time
+from datetime import datetime
 import re
 import io
+import csv
+import hashlib
 import logging
 import json
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cachetools import TTLCache
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev_secret_key")  # 使用環境變數
@@ -28,6 +35,35 @@ STOCK_NAMES_FILE = os.path.join(BASE_DIR, "stock_names.csv")
 TRANSACTIONS_CACHE = None
 TRANSACTIONS_CACHE_TIME = None
 TRANSACTIONS_CACHE_DURATION = 300  # 5分鐘緩存
+_TRANSACTIONS_LOCK = threading.Lock()
+
+# 股票信息緩存（30分鐘過期），由請求線程共享
+_STOCK_CACHE = TTLCache(maxsize=2048, ttl=1800)
+_STOCK_CACHE_LOCK = threading.Lock()
+
+# 判斷名稱是否包含中文字元
+_CJK_RE = re.compile(r'[\u4e00-\u9fff]')
+
+# Yahoo Finance 並行查詢的線程數
+YF_MAX_WORKERS = 8
+
+# 股票價格快照：{完整代碼: {"price": 價格, "name": 名稱}}
+# 更新時整體替換，讀取方只需綁定當前引用，不需加鎖
+_PRICES = {}
+_PRICES_LOCK = threading.Lock()
+
+# stock_names 工作表下一個空行的行號，讀取價格時初始化
+_next_names_row = None
+
+# 本地 stock_names.csv 緩存及其修改時間
+_stock_names_cache = None
+_stock_names_mtime = None
+
+# stock_names 工作表中已存在的股票代碼
+_known_codes = set()
+
+# 保護 _known_codes 與 _next_names_row：檢查、佔用行號及寫入須在同一把鎖內完成
+_NAMES_LOCK = threading.RLock()
 
 # Google Sheets 設置
 def setup_google_sheets():
@@ -50,44 +86,149 @@ def setup_google_sheets():
         logger.error(f"設置 Google Sheets 時出錯: {e}")
         return None
 
+# 全局 Google Sheets 客戶端，只在啟動時授權一次
+GS_CLIENT = setup_google_sheets()
+_GS_CLIENT_LOCK = threading.Lock()
+
+# 客戶端建立失敗時重新授權；令牌過期時只在原客戶端上刷新，保留已緩存的工作表
+def refresh_google_sheets_client():
+    global GS_CLIENT
+    recovered = False
+    with _GS_CLIENT_LOCK:
+        if GS_CLIENT is None:
+            client = setup_google_sheets()
+            if client:
+                recovered = True
+                GS_CLIENT = client
+                logger.info("已重新授權 Google Sheets 客戶端")
+        else:
+            creds = getattr(GS_CLIENT, 'auth', None)
+            if creds is not None and creds.expired:
+                creds.refresh(GoogleAuthRequest())
+                logger.info("已刷新 Google Sheets 憑證")
+        client = GS_CLIENT
+    
+    # 首次取得客戶端時補做初始化（檢查/創建工作表並讀取價格）
+    if recovered:
+        initialize_google_sheets()
+    return client
+
+# 定期檢查憑證是否過期
+def schedule_google_sheets_reauth(interval_minutes=5):
+    def reauth():
+        while True:
+            try:
+                time.sleep(interval_minutes * 60)
+                refresh_google_sheets_client()
+            except Exception as e:
+                logger.error(f"重新授權 Google Sheets 時出錯: {e}")
+    
+    # 啟動後台線程
+    thread = threading.Thread(target=reauth)
+    thread.daemon = True
+    thread.start()
+
+# 緩存已打開的試算表及工作表，避免每次重新獲取元數據
+_spreadsheet_cache = {}
+_worksheet_cache = {}
+
+# 打開試算表（每個客戶端只獲取一次元數據）
+def open_spreadsheet(client, sheet_name):
+    cached = _spreadsheet_cache.get(sheet_name)
+    if cached is not None and cached[0] is client:
+        return cached[1]
+    spreadsheet = client.open(sheet_name)
+    _spreadsheet_cache[sheet_name] = (client, spreadsheet)
+    return spreadsheet
+
+# 獲取工作表，不存在時拋出 WorksheetNotFound
+def open_worksheet(client, sheet_name, worksheet_name):
+    key = (sheet_name, worksheet_name)
+    cached = _worksheet_cache.get(key)
+    if cached is not None and cached[0] is client:
+        return cached[1]
+    worksheet = open_spreadsheet(client, sheet_name).worksheet(worksheet_name)
+    _worksheet_cache[key] = (client, worksheet)
+    return worksheet
+
+# 清除試算表的緩存句柄（網格變更或 API 出錯後，下次重新獲取元數據）
+def invalidate_sheet_cache(sheet_name, worksheet_name=None):
+    if worksheet_name is None:
+        _spreadsheet_cache.pop(sheet_name, None)
+        for key in [key for key in _worksheet_cache if key[0] == sheet_name]:
+            _worksheet_cache.pop(key, None)
+    else:
+        _worksheet_cache.pop((sheet_name, worksheet_name), None)
+
+# 創建工作表並加入緩存
+def create_worksheet(client, sheet_name, worksheet_name, rows, cols):
+    worksheet = open_spreadsheet(client, sheet_name).add_worksheet(title=worksheet_name, rows=rows, cols=cols)
+    _worksheet_cache[(sheet_name, worksheet_name)] = (client, worksheet)
+    return worksheet
+
 # 從 Google Sheets 讀取股票價格
 def get_prices_from_google_sheet(client, sheet_name, worksheet_name="stock_names"):
+    global _PRICES, _known_codes, _next_names_row
     try:
-        # 打開試算表
-        sheet = client.open(sheet_name).worksheet(worksheet_name)
+        # 以單次 batchGet 讀取整個 stock_names 範圍
+        response = open_spreadsheet(client, sheet_name).values_batch_get(
+            ranges=[f"{worksheet_name}!A1:D"],
+            params={"valueRenderOption": "UNFORMATTED_VALUE"})
+        value_ranges = response.get("valueRanges", [])
+        rows = value_ranges[0].get("values", []) if value_ranges else []
+        if not rows:
+            logger.warning(f"{worksheet_name} 工作表沒有數據")
+            return {}
+        
+        # 依標題行定位欄位
+        header = [str(h) for h in rows[0]]
+        if "code" not in header:
+            logger.warning(f"{worksheet_name} 工作表缺少 code 欄位: {header}")
+            return {}
+        code_idx = header.index("code")
         
-        # 讀取所有數據
-        data = sheet.get_all_records()
+        # 同步已存在的股票代碼及下一個可寫入的行號（標題行 + 已有數據行之後）
+        known_codes = {str(row[code_idx]) for row in rows[1:]
+                       if len(row) > code_idx and row[code_idx] != ""}
+        with _NAMES_LOCK:
+            _known_codes = known_codes
+            _next_names_row = len(rows) + 1
         
-        # 轉換為字典格式：{股票代碼: 價格}
-        prices = {}
-        for row in data:
-            if 'code' in row and 'price' in row:
-                try:
-                    # 確保代碼格式正確（帶有.TW或.TWO後綴）
-                    code = str(row['code'])
-                    # 如果代碼不包含後綴，嘗試添加.TW後綴
-                    if not code.endswith(('.TW', '.TWO')):
-                        code += '.TW'
-                    
-                    # 嘗試轉換為浮點數，如果失敗則跳過
-                    price_value = float(row['price'])
-                    prices[code] = price_value
-                    logger.debug(f"從 Google Sheets 讀取股票價格: {code} = {price_value}")
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"無法解析價格數據: {row}, 錯誤: {e}")
-                    continue
+        if "price" not in header:
+            logger.warning(f"{worksheet_name} 工作表缺少 price 欄位: {header}")
+            return {}
+        price_idx = header.index("price")
+        name_idx = header.index("name") if "name" in header else None
         
-        # 設置全局緩存
-        if hasattr(fetch_stock_info, 'google_sheets_prices'):
-            fetch_stock_info.google_sheets_prices = prices
-        else:
-            # 確保屬性存在
-            fetch_stock_info.google_sheets_prices = prices
+        # 轉換為字典格式：{股票代碼: {"price": 價格, "name": 名稱}}
+        snapshot = {}
+        for row in rows[1:]:
+            if len(row) <= max(code_idx, price_idx) or row[code_idx] == "":
+                continue
+            try:
+                # 確保代碼格式正確（帶有.TW或.TWO後綴）
+                code = str(row[code_idx])
+                # 如果代碼不包含後綴，嘗試添加.TW後綴
+                if not code.endswith(('.TW', '.TWO')):
+                    code += '.TW'
+                
+                # 嘗試轉換為浮點數，如果失敗則跳過
+                price_value = float(row[price_idx])
+                name = row[name_idx] if name_idx is not None and len(row) > name_idx else ""
+                snapshot[code] = {"price": price_value, "name": name}
+                logger.debug(f"從 Google Sheets 讀取股票價格: {code} = {price_value}")
+            except (ValueError, TypeError) as e:
+                logger.warning(f"無法解析價格數據: {row}, 錯誤: {e}")
+                continue
+        
+        # 原子替換全局快照，避免讀取到更新中的字典
+        with _PRICES_LOCK:
+            _PRICES = snapshot
             
-        logger.info(f"已從 Google Sheets 讀取 {len(prices)} 個股票價格")
-        return prices
+        logger.info(f"已從 Google Sheets 讀取 {len(snapshot)} 個股票價格")
+        return snapshot
     except Exception as e:
+        invalidate_sheet_cache(sheet_name)
         logger.error(f"從 Google Sheets 讀取數據時出錯: {e}")
         return {}
 
@@ -95,38 +236,57 @@ def get_prices_from_google_sheet(client, sheet_name, worksheet_name="stock_names
 def get_transactions_from_google_sheet(client, sheet_name, worksheet_name="交易紀錄"):
     try:
         # 打開試算表
-        sheet = client.open(sheet_name).worksheet(worksheet_name)
+        sheet = open_worksheet(client, sheet_name, worksheet_name)
         
-        # 讀取所有數據
-        data = sheet.get_all_records()
+        # 以未格式化的值讀取 A:H，數字欄位直接回傳數值，日期仍為字串
+        values = sheet.get('A:H', value_render_option='UNFORMATTED_VALUE',
+                           date_time_render_option='FORMATTED_STRING')
+        if not values:
+            return []
         
-        # 轉換為與原來相同的格式
+        # 轉換為與原來相同的格式（空白或被省略的數字欄位預設為 0）
+        headers = [str(h) for h in values[0]]
         transactions = []
-        for row in data:
+        for row in values[1:]:
+            record = dict(zip(headers, row))
             transactions.append({
-                "Date": row.get("Date", ""),
-                "Stock_Code": row.get("Stock_Code", ""),
-                "Stock_Name": row.get("Stock_Name", ""),
-                "Type": row.get("Type", ""),
-                "Quantity": float(row.get("Quantity", 0)),
-                "Price": float(row.get("Price", 0)),
-                "Fee": float(row.get("Fee", 0)),
-                "Tax": float(row.get("Tax", 0))
+                "Date": record.get("Date", ""),
+                "Stock_Code": record.get("Stock_Code", ""),
+                "Stock_Name": record.get("Stock_Name", ""),
+                "Type": record.get("Type", ""),
+                "Quantity": record.get("Quantity") or 0,
+                "Price": record.get("Price") or 0,
+                "Fee": record.get("Fee") or 0,
+                "Tax": record.get("Tax") or 0
             })
         
         return transactions
     except Exception as e:
+        invalidate_sheet_cache(sheet_name)
         logger.error(f"從 Google Sheets 讀取交易數據時出錯: {e}")
         return []
 
+# 將一行數值轉換為 Sheets API 的 RowData
+def _to_row_data(values):
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)):
+            cells.append({"userEnteredValue": {"numberValue": value}})
+        elif isinstance(value, str) and value.startswith("="):
+            cells.append({"userEnteredValue": {"formulaValue": value}})
+        else:
+            cells.append({"userEnteredValue": {"stringValue": str(value)}})
+    return {"values": cells}
+
 # 添加交易到 Google Sheets
 def add_transaction_to_google_sheet(client, sheet_name, worksheet_name, transaction):
+    global _next_names_row
     try:
         # 打開試算表
-        sheet = client.open(sheet_name).worksheet(worksheet_name)
+        spreadsheet = open_spreadsheet(client, sheet_name)
+        sheet = open_worksheet(client, sheet_name, worksheet_name)
         
-        # 直接添加新交易
-        sheet.append_row([
+        row = [
             transaction["Date"],
             transaction["Stock_Code"],
             transaction["Stock_Name"],
@@ -135,40 +295,68 @@ def add_transaction_to_google_sheet(client, sheet_name, worksheet_name, transact
             transaction["Price"],
             transaction["Fee"],
             transaction["Tax"]
-        ])
-        
-        logger.info(f"已添加交易: {transaction['Stock_Code']} {transaction['Type']} {transaction['Quantity']}股")
+        ]
+        stock_code = transaction["Stock_Code"]
         
-        # 如果是買入交易，檢查並添加股票到 stock_names 工作表
-        if transaction["Type"] == "Buy":
-            # 提取股票代碼
-            stock_code = transaction["Stock_Code"]
+        # 如果是買入交易且股票不在 stock_names 工作表，與交易合併為單一 batchUpdate
+        # 檢查、佔用行號與寫入在同一把鎖內，避免並發新增寫入同一行
+        with _NAMES_LOCK:
+            is_new_stock = (transaction["Type"] == "Buy" and
+                            not check_stock_exists_in_names(client, sheet_name, stock_code))
+            stock_names_sheet = None
+            if is_new_stock:
+                try:
+                    stock_names_sheet = open_worksheet(client, sheet_name, "stock_names")
+                except gspread.exceptions.WorksheetNotFound:
+                    logger.warning("stock_names 工作表不存在")
             
-            # 檢查股票是否已存在於 stock_names 工作表
-            if not check_stock_exists_in_names(client, sheet_name, stock_code):
-                # 添加新股票到 stock_names 工作表
-                add_stock_to_names_sheet(client, sheet_name, stock_code, transaction["Stock_Name"])
+            if stock_names_sheet is not None:
+                next_row = resolve_next_names_row(client, sheet_name, stock_names_sheet)
+                
+                # 新股票寫入明確的行號，確保價格公式 =D{next_row} 指向同一行
+                names_row = build_stock_names_row(stock_code, transaction["Stock_Name"], next_row)
+                spreadsheet.batch_update({"requests": [
+                    {"appendCells": {"sheetId": sheet.id, "rows": [_to_row_data(row)],
+                                     "fields": "userEnteredValue"}},
+                    {"updateCells": {"start": {"sheetId": stock_names_sheet.id,
+                                               "rowIndex": next_row - 1, "columnIndex": 0},
+                                     "rows": [_to_row_data(names_row)],
+                                     "fields": "userEnteredValue"}}
+                ]})
+                _known_codes.add(stock_code)
+                _next_names_row = next_row + 1
+                logger.info(f"已添加交易: {stock_code} {transaction['Type']} {transaction['Quantity']}股")
+                logger.info(f"已將新股票 {stock_code} 添加到 stock_names 工作表，行号: {next_row}")
+                return True
+        
+        # 直接添加新交易
+        sheet.append_rows([row], insert_data_option='INSERT_ROWS')
+        
+        logger.info(f"已添加交易: {stock_code} {transaction['Type']} {transaction['Quantity']}股")
+        
+        # stock_names 工作表不存在時，由 add_stock_to_names_sheet 建立並寫入
+        if is_new_stock:
+            if add_stock_to_names_sheet(client, sheet_name, stock_code, transaction["Stock_Name"]):
                 logger.info(f"已將新股票 {stock_code} 添加到 stock_names 工作表")
-            else:
-                logger.info(f"股票 {stock_code} 已存在於 stock_names 工作表")
+        elif transaction["Type"] == "Buy":
+            logger.info(f"股票 {stock_code} 已存在於 stock_names 工作表")
         
         return True
     except Exception as e:
+        invalidate_sheet_cache(sheet_name)
         logger.error(f"添加交易到 Google Sheets 時出錯: {e}")
         return False
 
 # 從 Google Sheets 刪除交易
 def delete_transaction_from_google_sheet(client, sheet_name, worksheet_name, transaction_index):
     try:
-        # 打開試算表
-        sheet = client.open(sheet_name).worksheet(worksheet_name)
-        
         # 刪除指定行（行號從1開始，標題行是第一行，所以交易數據從第2行開始）
         # transaction_index 是交易列表中的索引，需要轉換為Google Sheets中的行號
         row_number = transaction_index + 2  # +2 是因為標題行(1)和0-based索引
         
-        # 刪除行
-        sheet.delete_rows(row_number)
+        # 刪除行（與批量刪除共用 deleteDimension 請求）
+        if not delete_transactions_from_google_sheet(client, sheet_name, worksheet_name, [transaction_index]):
+            return False
         
         logger.info(f"已刪除交易，行號: {row_number}")
         return True
@@ -176,111 +364,144 @@ def delete_transaction_from_google_sheet(client, sheet_name, worksheet_name, tra
         logger.error(f"從 Google Sheets 刪除交易時出錯: {e}")
         return False
 
-# 檢查股票是否存在於 stock_names 工作表
-def check_stock_exists_in_names(client, sheet_name, full_code):
+# 從 Google Sheets 批量刪除交易（單一 batchUpdate）
+def delete_transactions_from_google_sheet(client, sheet_name, worksheet_name, transaction_indices):
     try:
-        stock_names_sheet = client.open(sheet_name).worksheet("stock_names")
-        records = stock_names_sheet.get_all_values()
+        sheet = open_worksheet(client, sheet_name, worksheet_name)
         
-        # 检查所有记录，查找匹配的代码
-        for row in records:
-            if len(row) > 0 and row[0] == full_code:  # 第一列是代码
-                return True
-        return False
-    except gspread.exceptions.WorksheetNotFound:
-        logger.warning("stock_names 工作表不存在")
-        return False
+        # 由下往上刪除，避免前面的刪除改變後面的行號
+        requests = [
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": sheet.id,
+                        "dimension": "ROWS",
+                        "startIndex": index + 1,  # 0-based，+1 跳過標題行
+                        "endIndex": index + 2
+                    }
+                }
+            }
+            for index in sorted(set(transaction_indices), reverse=True)
+        ]
+        if requests:
+            open_spreadsheet(client, sheet_name).batch_update({"requests": requests})
+        
+        logger.info(f"已批量刪除 {len(requests)} 筆交易")
+        return True
     except Exception as e:
-        logger.error(f"检查股票是否存在时出错: {e}")
+        invalidate_sheet_cache(sheet_name)
+        logger.error(f"從 Google Sheets 批量刪除交易時出錯: {e}")
         return False
 
+# 檢查股票是否存在於 stock_names 工作表
+def check_stock_exists_in_names(client, sheet_name, full_code):
+    global _known_codes, _next_names_row
+    with _NAMES_LOCK:
+        # 先查本地已知代碼集合
+        if full_code in _known_codes:
+            return True
+        # 讀取失敗時不保留可能過期的行號
+        _next_names_row = None
+        try:
+            stock_names_sheet = open_worksheet(client, sheet_name, "stock_names")
+            # 只讀取第一列（代码），同時更新下一個空行的行號
+            column = stock_names_sheet.col_values(1)
+            _next_names_row = len(column) + 1
+            codes = set(column)
+            _known_codes = _known_codes | codes
+            return full_code in codes
+        except gspread.exceptions.WorksheetNotFound:
+            logger.warning("stock_names 工作表不存在")
+            return False
+        except Exception as e:
+            invalidate_sheet_cache(sheet_name)
+            logger.error(f"检查股票是否存在时出错: {e}")
+            return False
+
+# 確定 stock_names 下一個空行並確保網格足夠（呼叫方須持有 _NAMES_LOCK）
+def resolve_next_names_row(client, sheet_name, stock_names_sheet):
+    # 优先使用本地行号计数，未初始化时只读取第一列
+    if _next_names_row is not None:
+        next_row = _next_names_row
+    else:
+        next_row = len(stock_names_sheet.col_values(1)) + 1
+    
+    # 检查是否超出网格限制
+    if next_row > stock_names_sheet.row_count:
+        # 增加行数
+        new_row_count = stock_names_sheet.row_count + 100
+        stock_names_sheet.add_rows(100)
+        invalidate_sheet_cache(sheet_name, "stock_names")
+        logger.info(f"已增加 stock_names 工作表行数，当前行数: {new_row_count}")
+    return next_row
+
+# 構建 stock_names 工作表的一行：code, price, name, pricenow
+def build_stock_names_row(full_code, name, row_number):
+    if full_code.endswith('.TWO'):
+        # 上櫃股票
+        yahoo_code = full_code
+    else:
+        # 上市股票
+        yahoo_code = full_code.replace(".TW", "") + ".TW"
+    formula = f'=IMPORTXML("https://tw.stock.yahoo.com/quote/{yahoo_code}","//*[@id=\'main-0-QuoteHeader-Proxy\']/div/div[2]/div[1]/div/span[1]")'
+    return [full_code, f'=D{row_number}', name, formula]
+
 # 添加新股票到 stock_names 工作表
 def add_stock_to_names_sheet(client, sheet_name, full_code, name):
+    global _next_names_row
     try:
-        # 尝试获取 stock_names 工作表，如果不存在则创建
-        try:
-            stock_names_sheet = client.open(sheet_name).worksheet("stock_names")
-        except gspread.exceptions.WorksheetNotFound:
-            # 创建更大的工作表（1000 行，10 列）
-            stock_names_sheet = client.open(sheet_name).add_worksheet(title="stock_names", rows=1000, cols=10)
-            # 添加标题行，注意顺序：code, price, name, pricenow
-            stock_names_sheet.append_row(["code", "price", "name", "pricenow"])
-            logger.info("已创建 stock_names 工作表")
-        
-        # 获取所有记录
-        records = stock_names_sheet.get_all_values()
-        
-        # 找到第一个空行
-        next_row = len(records) + 1
-        
-        # 检查是否超出网格限制
-        if next_row > stock_names_sheet.row_count:
-            # 增加行数
-            stock_names_sheet.add_rows(100)
-            logger.info(f"已增加 stock_names 工作表行数，当前行数: {stock_names_sheet.row_count}")
-        
-        # 构建公式
-        if full_code.endswith('.TWO'):
-            # 上櫃股票
-            yahoo_code = full_code.replace(".TWO", ".TWO")
-            formula = f'=IMPORTXML("https://tw.stock.yahoo.com/quote/{yahoo_code}","//*[@id=\'main-0-QuoteHeader-Proxy\']/div/div[2]/div[1]/div/span[1]")'
-        else:
-            # 上市股票
-            yahoo_code = full_code.replace(".TW", "") + ".TW"
-            formula = f'=IMPORTXML("https://tw.stock.yahoo.com/quote/{yahoo_code}","//*[@id=\'main-0-QuoteHeader-Proxy\']/div/div[2]/div[1]/div/span[1]")'
-        
-        # 使用批量更新
-        batch_data = [
-            {
-                'range': f'A{next_row}',
-                'values': [[full_code]]
-            },
-            {
-                'range': f'B{next_row}',
-                'values': [[f'=D{next_row}']]
-            },
-            {
-                'range': f'C{next_row}',
-                'values': [[name]]
-            },
-            {
-                'range': f'D{next_row}',
-                'values': [[formula]]
-            }
-        ]
-        
-        # 执行批量更新，使用 USER_ENTERED 选项
-        stock_names_sheet.batch_update(batch_data, value_input_option='USER_ENTERED')
-        
+        with _NAMES_LOCK:
+            # 尝试获取 stock_names 工作表，如果不存在则创建
+            try:
+                stock_names_sheet = open_worksheet(client, sheet_name, "stock_names")
+            except gspread.exceptions.WorksheetNotFound:
+                # 创建更大的工作表（1000 行，10 列）
+                stock_names_sheet = create_worksheet(client, sheet_name, "stock_names", rows=1000, cols=10)
+                # 添加标题行，注意顺序：code, price, name, pricenow
+                stock_names_sheet.append_row(["code", "price", "name", "pricenow"])
+                _next_names_row = 2
+                logger.info("已创建 stock_names 工作表")
+            
+            # 找到第一个空行并确保网格足够
+            next_row = resolve_next_names_row(client, sheet_name, stock_names_sheet)
+            
+            # 单次写入明确的整行范围，使用 USER_ENTERED 选项
+            stock_names_sheet.update(f"A{next_row}:D{next_row}",
+                                     [build_stock_names_row(full_code, name, next_row)],
+                                     value_input_option='USER_ENTERED')
+            
+            _next_names_row = next_row + 1
+            _known_codes.add(full_code)
         logger.info(f"已将股票 {full_code} {name} 添加到 stock_names 工作表，行号: {next_row}")
         return True
     except Exception as e:
+        invalidate_sheet_cache(sheet_name)
         logger.error(f"添加股票到 stock_names 工作表时出错: {e}")
         return False
 
 # 在應用啟動時初始化 Google Sheets 連接
 def initialize_google_sheets():
     try:
-        client = setup_google_sheets()
+        client = GS_CLIENT
         if client:
             # 從環境變量獲取試算表名稱
             sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
             
             # 檢查交易紀錄工作表是否存在，如果不存在則創建
             try:
-                sheet = client.open(sheet_name).worksheet("交易紀錄")
+                sheet = open_worksheet(client, sheet_name, "交易紀錄")
             except gspread.exceptions.WorksheetNotFound:
                 # 創建交易紀錄工作表
-                sheet = client.open(sheet_name).add_worksheet(title="交易紀錄", rows=1000, cols=20)
+                sheet = create_worksheet(client, sheet_name, "交易紀錄", rows=1000, cols=20)
                 # 添加標題行
                 sheet.append_row(["Date", "Stock_Code", "Stock_Name", "Type", "Quantity", "Price", "Fee", "Tax"])
             
             # 檢查 stock_names 工作表是否存在，如果不存在則創建
             try:
-                stock_names_sheet = client.open(sheet_name).worksheet("stock_names")
+                stock_names_sheet = open_worksheet(client, sheet_name, "stock_names")
             except gspread.exceptions.WorksheetNotFound:
                 # 創建 stock_names 工作表
-                stock_names_sheet = client.open(sheet_name).add_worksheet(title="stock_names", rows=1000, cols=10)
+                stock_names_sheet = create_worksheet(client, sheet_name, "stock_names", rows=1000, cols=10)
                 # 添加標題行
                 stock_names_sheet.append_row(["code", "name", "price", "pricenow"])
             
@@ -299,7 +520,7 @@ def schedule_google_sheets_update(interval_minutes=30):
         while True:
             try:
                 time.sleep(interval_minutes * 60)
-                client = setup_google_sheets()
+                client = GS_CLIENT
                 if client:
                     sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
                     get_prices_from_google_sheet(client, sheet_name, "stock_names")
@@ -312,107 +533,123 @@ def schedule_google_sheets_update(interval_minutes=30):
     thread.daemon = True
     thread.start()
 
+# 重新讀取 Google Sheets 價格並清除股票信息緩存（含 Yahoo Finance 備援價格）
+def refresh_all_prices(client, sheet_name):
+    prices = get_prices_from_google_sheet(client, sheet_name, "stock_names")
+    with _STOCK_CACHE_LOCK:
+        _STOCK_CACHE.clear()
+    return prices
+
 # 獲取交易數據（使用緩存）
 def get_transactions():
     global TRANSACTIONS_CACHE, TRANSACTIONS_CACHE_TIME
     
-    current_time = time.time()
-    if (TRANSACTIONS_CACHE is not None and 
-        TRANSACTIONS_CACHE_TIME is not None and
-        current_time - TRANSACTIONS_CACHE_TIME < TRANSACTIONS_CACHE_DURATION):
-        logger.info("使用緩存的交易數據")
-        return TRANSACTIONS_CACHE
-    
-    try:
-        client = setup_google_sheets()
-        if client:
-            sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
-            transactions = get_transactions_from_google_sheet(client, sheet_name, "交易紀錄")
-            TRANSACTIONS_CACHE = transactions
-            TRANSACTIONS_CACHE_TIME = current_time
-            logger.info(f"從 Google Sheets 讀取 {len(transactions)} 筆交易數據")
-            return transactions
-        else:
-            logger.warning("無法連接到 Google Sheets，返回空交易列表")
+    with _TRANSACTIONS_LOCK:
+        current_time = time.monotonic()
+        if (TRANSACTIONS_CACHE is not None and 
+            TRANSACTIONS_CACHE_TIME is not None and
+            current_time - TRANSACTIONS_CACHE_TIME < TRANSACTIONS_CACHE_DURATION):
+            logger.info("使用緩存的交易數據")
+            return TRANSACTIONS_CACHE
+        
+        try:
+            client = GS_CLIENT
+            if client:
+                sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
+                transactions = get_transactions_from_google_sheet(client, sheet_name, "交易紀錄")
+                TRANSACTIONS_CACHE = transactions
+                TRANSACTIONS_CACHE_TIME = current_time
+                logger.info(f"從 Google Sheets 讀取 {len(transactions)} 筆交易數據")
+                return transactions
+            else:
+                logger.warning("無法連接到 Google Sheets，返回空交易列表")
+                return []
+        except Exception as e:
+            logger.error(f"獲取交易數據時出錯: {e}")
             return []
-    except Exception as e:
-        logger.error(f"獲取交易數據時出錯: {e}")
-        return []
 
-# Load stock names from CSV with encoding fallback
+# 清除交易緩存
+def invalidate_transactions_cache():
+    global TRANSACTIONS_CACHE
+    with _TRANSACTIONS_LOCK:
+        TRANSACTIONS_CACHE = None
+
+# 從緩存移除已刪除的交易；建立新列表後替換，不修改其他請求正在使用的列表
+def remove_cached_transaction(transaction_index):
+    global TRANSACTIONS_CACHE
+    with _TRANSACTIONS_LOCK:
+        cache = TRANSACTIONS_CACHE
+        if cache is not None and 0 <= transaction_index < len(cache):
+            TRANSACTIONS_CACHE = cache[:transaction_index] + cache[transaction_index + 1:]
+        else:
+            TRANSACTIONS_CACHE = None
+
+# 以指定編碼讀取 stock_names.csv，返回 (標題行, 數據行)
+def _read_stock_names_csv(encoding):
+    with open(STOCK_NAMES_FILE, encoding=encoding, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return header, list(reader)
+
+# Load stock names from CSV with encoding fallback（依檔案修改時間緩存）
 def load_stock_names():
+    global _stock_names_cache, _stock_names_mtime
     try:
         if not os.path.exists(STOCK_NAMES_FILE):
             logger.warning(f"{STOCK_NAMES_FILE} 不存在，使用空映射")
             return {}
+        mtime = os.path.getmtime(STOCK_NAMES_FILE)
+        if _stock_names_cache is not None and mtime == _stock_names_mtime:
+            return _stock_names_cache
         try:
-            df = pd.read_csv(STOCK_NAMES_FILE, encoding='utf-8-sig')
+            header, rows = _read_stock_names_csv('utf-8-sig')
         except UnicodeDecodeError:
             logger.warning("無法以 utf-8-sig 編碼讀取 stock_names.csv，嘗試 big5")
             try:
-                df = pd.read_csv(STOCK_NAMES_FILE, encoding='big5')
+                header, rows = _read_stock_names_csv('big5')
             except UnicodeDecodeError:
                 logger.error("無法以 utf-8-sig 或 big5 編碼讀取 stock_names.csv，請檢查檔案編碼")
                 return {}
         expected_columns = ["Code", "Name", "Market"]
-        if list(df.columns) != expected_columns:
+        if header != expected_columns:
             logger.error(f"{STOCK_NAMES_FILE} 格式錯誤，應包含欄位: {expected_columns}")
             return {}
-        stock_names = {}
-        for _, row in df.iterrows():
-            try:
-                code = str(row["Code"])
-                market = row["Market"]
-                name = row["Name"]
-                stock_names[(code, market)] = name
-                logger.debug(f"股票映射: 代碼={code}, 市場={market}, 名稱={name}")
-            except Exception as e:
-                logger.warning(f"跳過無效行: {row.to_dict()}, 錯誤: {e}")
+        stock_names = {(row[0], row[2]): row[1] for row in rows if len(row) >= 3}
+        _stock_names_cache = stock_names
+        _stock_names_mtime = mtime
         logger.info(f"成功載入 {len(stock_names)} 個股票名稱")
         return stock_names
     except Exception as e:
         logger.error(f"載入 {STOCK_NAMES_FILE} 失敗: {e}")
         return {}
 
+# 解析完整代碼為 (代碼, 是否上櫃, 市場鍵)
+@lru_cache(maxsize=512)
+def parse_stock_code(full_code):
+    code = full_code.split('.')[0]
+    if full_code.endswith(".TWO"):
+        return code, True, "TWO"
+    return code, False, "TWSE"
+
 # Fetch stock info - 使用 Google Sheets 數據
-def fetch_stock_info(full_code):
+def fetch_stock_info(full_code, stock_names, prices):
     # 從完整代碼中提取基本信息
-    if full_code.endswith(".TWO"):
-        code = full_code.split('.')[0]
-        is_otc = True
-        market_key = "TWO"
-    else:
-        code = full_code.split('.')[0]
-        is_otc = False
-        market_key = "TWSE"
-    
-    # 確保 google_sheets_prices 屬性存在
-    if not hasattr(fetch_stock_info, 'google_sheets_prices'):
-        fetch_stock_info.google_sheets_prices = {}
-    
-    # 確保緩存存在
-    if not hasattr(fetch_stock_info, 'cache'):
-        fetch_stock_info.cache = {}
+    code, is_otc, market_key = parse_stock_code(full_code)
     
-    # 使用緩存來減少 API 請求
+    # 使用緩存來減少 API 請求（30分鐘過期）
     cache_key = full_code
-    current_time = time.time()
-    
-    # 檢查緩存是否存在且未過期（30分鐘）
-    cached_data = fetch_stock_info.cache.get(cache_key)
-    if cached_data and current_time - cached_data['timestamp'] < 1800:  # 30分鐘緩存
+    with _STOCK_CACHE_LOCK:
+        cached_data = _STOCK_CACHE.get(cache_key)
+    if cached_data is not None:
         logger.info(f"使用緩存的股票數據: {cache_key}")
-        return cached_data['data']
+        return cached_data
     
-    # 從本地 CSV 獲取股票名稱
-    stock_names = load_stock_names()
+    # 從預先載入的股票名稱映射獲取名稱
     name_key = (str(code), market_key)
     name = stock_names.get(name_key, "未知名稱")
     
-    # 嘗試從 Google Sheets 獲取價格 - 使用完整代碼（帶後綴）
-    price = 0
-    if fetch_stock_info.google_sheets_prices:
-        price = fetch_stock_info.google_sheets_prices.get(full_code, 0)
+    # 嘗試從 Google Sheets 價格快照獲取價格 - 使用完整代碼（帶後綴）
+    price = prices.get(full_code, {}).get("price", 0)
     
     # 如果 Google Sheets 沒有數據，嘗試使用 Yahoo Finance
     if price == 0:
@@ -429,13 +666,18 @@ def fetch_stock_info(full_code):
     result = {"price": round(price, 2), "name": name}
     
     # 更新緩存
-    fetch_stock_info.cache[cache_key] = {
-        'timestamp': current_time,
-        'data': result
-    }
+    with _STOCK_CACHE_LOCK:
+        _STOCK_CACHE[cache_key] = result
     
     return result
 
+# 計算手續費及交易稅（向量化，適用於批量交易）
+def compute_fee_tax(quantity, price, trans_type):
+    amount = np.asarray(quantity, dtype=float) * np.asarray(price, dtype=float)
+    fee = np.maximum(20, amount * 0.001425)
+    tax = np.where(np.asarray(trans_type) == "Sell", amount * 0.003, 0.0)
+    return fee, tax
+
 # Calculate portfolio summary
 def get_portfolio_summary(transactions=None):
     if transactions is None:
@@ -444,42 +686,60 @@ def get_portfolio_summary(transactions=None):
     if not transactions:
         return [], 0, 0, 0, 0, 0
 
-    # 使用字典來跟踪每個股票的狀態
-    stock_status = {}
-    
-    for row in transactions:
-        # 提取不帶後綴的股票代碼
-        code_without_suffix = row["Stock_Code"].split('.')[0]
-        full_code = row["Stock_Code"]
-        
-        if full_code not in stock_status:
-            stock_status[full_code] = {
-                "name": row["Stock_Name"],
-                "quantity": 0,
-                "total_buy_cost": 0,  # 總買入成本
-                "total_sell_revenue": 0,  # 總賣出收入
-                "total_fee_tax": 0,  # 總手續費和稅
-                "buy_quantity": 0,  # 總買入股數
-                "sell_quantity": 0,  # 總賣出股數
-                "realized_profit": 0,  # 已實現損益
-                "is_otc": row["Stock_Code"].endswith(".TWO")
+    # 轉換為 DataFrame，以向量化方式計算每筆交易的貢獻
+    df = pd.DataFrame(transactions)
+    is_buy = (df["Type"] == "Buy").to_numpy()
+    quantity = df["Quantity"].to_numpy(dtype=float)
+    price = df["Price"].to_numpy(dtype=float)
+    fee_tax = df["Fee"].to_numpy(dtype=float) + df["Tax"].to_numpy(dtype=float)
+    gross = quantity * price
+
+    df["signed_qty"] = np.where(is_buy, quantity, -quantity)
+    df["buy_cost"] = np.where(is_buy, gross + fee_tax, 0.0)  # 買入成本
+    df["sell_rev"] = np.where(is_buy, 0.0, gross - fee_tax)  # 賣出收入
+    df["buy_qty"] = np.where(is_buy, quantity, 0.0)
+    df["sell_qty"] = np.where(is_buy, 0.0, quantity)
+    df["fee_tax"] = fee_tax
+
+    # 計算已實現損益：賣出時以當下累計的平均買入成本計算
+    grouped = df.groupby("Stock_Code", sort=False)
+    cum_buy_cost = grouped["buy_cost"].cumsum().to_numpy()
+    cum_buy_qty = grouped["buy_qty"].cumsum().to_numpy()
+    avg_buy_at_row = np.divide(cum_buy_cost, cum_buy_qty,
+                               out=np.zeros_like(cum_buy_cost), where=cum_buy_qty > 0)
+    df["realized"] = np.where(is_buy, 0.0, (price - avg_buy_at_row) * quantity - fee_tax)
+
+    # 按股票彙總，保持交易中首次出現的順序
+    agg = df.groupby("Stock_Code", sort=False).agg(
+        name=("Stock_Name", "first"),
+        quantity=("signed_qty", "sum"),
+        total_buy_cost=("buy_cost", "sum"),  # 總買入成本
+        total_sell_revenue=("sell_rev", "sum"),  # 總賣出收入
+        total_fee_tax=("fee_tax", "sum"),  # 總手續費和稅
+        buy_quantity=("buy_qty", "sum"),  # 總買入股數
+        sell_quantity=("sell_qty", "sum"),  # 總賣出股數
+        realized_profit=("realized", "sum"),  # 已實現損益
+    )
+    stock_status = agg.to_dict("index")
+
+    # 每次計算只讀取一次價格快照
+    snapshot = _PRICES
+
+    # 第一輪：找出持有中但快照沒有價格的股票，並行向 Yahoo Finance 查詢
+    missing_codes = [
+        full_code for full_code, data in stock_status.items()
+        if data["quantity"] > 0 and not snapshot.get(full_code, {}).get("price")
+    ]
+    fallback_prices = {}
+    if missing_codes:
+        stock_names = load_stock_names()
+        with ThreadPoolExecutor(max_workers=YF_MAX_WORKERS) as executor:
+            futures = {
+                full_code: executor.submit(fetch_stock_info, full_code, stock_names, snapshot)
+                for full_code in missing_codes
             }
-        
-        if row["Type"] == "Buy":
-            stock_status[full_code]["quantity"] += row["Quantity"]
-            stock_status[full_code]["total_buy_cost"] += row["Quantity"] * row["Price"] + row["Fee"] + row["Tax"]
-            stock_status[full_code]["buy_quantity"] += row["Quantity"]
-            stock_status[full_code]["total_fee_tax"] += row["Fee"] + row["Tax"]
-        else:  # Sell
-            stock_status[full_code]["quantity"] -= row["Quantity"]
-            stock_status[full_code]["total_sell_revenue"] += row["Quantity"] * row["Price"] - row["Fee"] - row["Tax"]
-            stock_status[full_code]["sell_quantity"] += row["Quantity"]
-            stock_status[full_code]["total_fee_tax"] += row["Fee"] + row["Tax"]
-            
-            # 計算已實現損益
-            avg_buy_price = stock_status[full_code]["total_buy_cost"] / stock_status[full_code]["buy_quantity"] if stock_status[full_code]["buy_quantity"] > 0 else 0
-            realized_profit = (row["Price"] - avg_buy_price) * row["Quantity"] - row["Fee"] - row["Tax"]
-            stock_status[full_code]["realized_profit"] += realized_profit
+            for full_code, future in futures.items():
+                fallback_prices[full_code] = future.result()["price"]
 
     result = []
     total_cost = 0
@@ -494,8 +754,10 @@ def get_portfolio_summary(transactions=None):
         # 獲取當前股價（只有當持有股數大於0時才需要）
         current_price = 0
         if data["quantity"] > 0:
-            stock_info = fetch_stock_info(full_code)
-            current_price = stock_info["price"]
+            if full_code in fallback_prices:
+                current_price = fallback_prices[full_code]
+            else:
+                current_price = round(snapshot[full_code]["price"], 2)
         
         # 計算市值和未實現損益
         market_value = data["quantity"] * current_price
@@ -530,9 +792,6 @@ def get_portfolio_summary(transactions=None):
 # 主頁面路由
 @app.route("/", methods=["GET", "POST"])
 def index():
-    global TRANSACTIONS_CACHE
-    
-    initialize_google_sheets()
     error = None
     stock_name = None
     default_date = datetime.now().strftime("%Y-%m-%d")
@@ -570,8 +829,8 @@ def index():
                     quantity = float(quantity)
                     price = float(price)
                     # 自動計算手續費和交易稅
-                    fee = max(20, price * quantity * 0.001425)
-                    tax = price * quantity * 0.003 if trans_type == "Sell" else 0
+                    fee, tax = compute_fee_tax([quantity], [price], [trans_type])
+                    fee, tax = float(fee[0]), float(tax[0])
 
                     code_with_suffix = f"{code}.TWO" if market == "TWO" else f"{code}.TW"
                     new_transaction = {
@@ -586,12 +845,12 @@ def index():
                     }
                     
                     # 添加到 Google Sheets
-                    client = setup_google_sheets()
+                    client = GS_CLIENT
                     if client:
                         sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
                         if add_transaction_to_google_sheet(client, sheet_name, "交易紀錄", new_transaction):
                             # 清除交易緩存
-                            TRANSACTIONS_CACHE = None
+                            invalidate_transactions_cache()
                             add_transaction_message = "交易已新增！"
                             
                             # 重新獲取交易數據
@@ -609,15 +868,11 @@ def index():
         
         elif action == "update_all_prices":
             try:
-                client = setup_google_sheets()
+                client = GS_CLIENT
                 if client:
                     sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
-                    # 强制重新从 Google Sheets 读取价格数据
-                    get_prices_from_google_sheet(client, sheet_name, "stock_names")
-                    
-                    # 清除股票信息缓存，强制重新获取所有股票的最新价格
-                    if hasattr(fetch_stock_info, 'cache'):
-                        fetch_stock_info.cache = {}
+                    # 强制重新读取价格数据并清除股票信息缓存
+                    refresh_all_prices(client, sheet_name)
                     
                     # 重新计算投资组合摘要
                     summary, total_quantity, total_cost, total_market_value, total_unrealized_profit, total_realized_profit = get_portfolio_summary(transactions)
@@ -636,15 +891,15 @@ def index():
                 if transaction_index is not None:
                     transaction_index = int(transaction_index)
                     
-                    client = setup_google_sheets()
+                    client = GS_CLIENT
                     if client:
                         sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
                         if delete_transaction_from_google_sheet(client, sheet_name, "交易紀錄", transaction_index):
-                            # 清除交易緩存
-                            TRANSACTIONS_CACHE = None
+                            # 直接從緩存移除該筆交易，無需重新讀取整個工作表
+                            remove_cached_transaction(transaction_index)
                             delete_transaction_message = "交易已刪除！"
                             
-                            # 重新獲取交易數據
+                            # 緩存仍有效時直接返回更新後的列表
                             transactions = get_transactions()
                             summary, total_quantity, total_cost, total_market_value, total_unrealized_profit, total_realized_profit = get_portfolio_summary(transactions)
                         else:
@@ -673,11 +928,27 @@ def index():
         delete_transaction_message=delete_transaction_message
     )
 
+# 按需重新讀取 Google Sheets 價格
+@app.route("/refresh_prices", methods=["POST"])
+def refresh_prices():
+    client = GS_CLIENT
+    if not client:
+        response = jsonify({"error": "無法連接到 Google Sheets"})
+        response.headers["Content-Type"] = "application/json; charset=utf-8"
+        return response, 503
+    
+    sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
+    prices = refresh_all_prices(client, sheet_name)
+    logger.info(f"已按需更新 {len(prices)} 個股票價格")
+    response = jsonify({"count": len(prices)})
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    return response
+
 # 獲取股票名稱
-@app.route("/fetch_stock_name", methods=["POST"])
+@app.route("/fetch_stock_name", methods=["GET", "POST"])
 def fetch_stock_name():
-    code = request.form.get("code", "").strip()
-    market = request.form.get("market", "TWSE")
+    code = request.values.get("code", "").strip()
+    market = request.values.get("market", "TWSE")
     logger.info(f"收到查詢請求: 代碼={code}, 市場={market}")
     
     if not code:
@@ -728,28 +999,36 @@ def fetch_stock_name():
             response.headers["Content-Type"] = "application/json; charset=utf-8"
             return response
     
-    logger.info(f"返回股票名稱: {name}")
-    response = jsonify({"name": name, "is_english": not re.search(r'[\u4e00-\u9fff]', name)})
-    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    # 結果幾乎不變，使用 ETag 讓瀏覽器重用響應
+    etag = hashlib.blake2s(f"{code}|{market}|{name}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        logger.info(f"返回股票名稱: {name}")
+        response = jsonify({"name": name, "is_english": not _CJK_RE.search(name)})
+        response.headers["Content-Type"] = "application/json; charset=utf-8"
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=86400"
     return response
 
 # 匯出交易紀錄
 @app.route("/export_transactions")
 def export_transactions():
     try:
-        client = setup_google_sheets()
+        client = GS_CLIENT
         if client:
             sheet_name = os.environ.get('GOOGLE_SHEET_NAME', '股票投資管理')
-            transactions = get_transactions_from_google_sheet(client, sheet_name, "交易紀錄")
+            rows = open_worksheet(client, sheet_name, "交易紀錄").get_all_values()
             
-            # 轉換為 DataFrame 並導出為 CSV
-            df = pd.DataFrame(transactions)
-            output = io.StringIO()
-            df.to_csv(output, index=False, encoding='utf-8-sig')
+            # 直接將原始行寫入 CSV（utf-8-sig 帶 BOM）
+            output = io.BytesIO()
+            text = io.TextIOWrapper(output, encoding='utf-8-sig', newline='', write_through=True)
+            csv.writer(text).writerows(rows)
+            text.detach()
             output.seek(0)
             
             return send_file(
-                io.BytesIO(output.getvalue().encode("utf-8-sig")),
+                output,
                 mimetype="text/csv; charset=utf-8",
                 as_attachment=True,
                 download_name=f"exported_transactions_{datetime.now().strftime('%Y%m%d')}.csv"
@@ -761,9 +1040,29 @@ def export_transactions():
         flash(f"匯出失敗: {e}", "error")
         return redirect(url_for("index"))
 
-# 初始化 Google Sheets 並啟動定期更新
+# 後台線程所屬的進程 ID；gunicorn --preload 下，主進程的線程不會被 fork 到 worker
+_BACKGROUND_PID = None
+_BACKGROUND_LOCK = threading.Lock()
+
+# 在當前進程中啟動定期更新線程（每個進程只啟動一次）
+def start_background_tasks():
+    global _BACKGROUND_PID
+    with _BACKGROUND_LOCK:
+        if _BACKGROUND_PID == os.getpid():
+            return
+        _BACKGROUND_PID = os.getpid()
+    schedule_google_sheets_update(30)  # 每30分鐘更新一次
+    schedule_google_sheets_reauth(5)  # 每5分鐘檢查憑證
+    logger.info(f"已在進程 {os.getpid()} 啟動定期更新線程")
+
+# 在處理請求的進程（worker）中確保後台線程已啟動
+@app.before_request
+def ensure_background_tasks():
+    start_background_tasks()
+
+# 預先載入股票名稱並初始化 Google Sheets
+load_stock_names()
 initialize_google_sheets()
-schedule_google_sheets_update(30)  # 每30分鐘更新一次
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))